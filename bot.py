@@ -1,26 +1,89 @@
 """A telegram bot"""
 
-import os
+import signal
 import logging
-import json
+import secrets
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram.ext import Updater, ConversationHandler, CommandHandler
 from telegram.ext import MessageHandler, CallbackQueryHandler, Filters
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InputMediaPhoto, Bot
+from telegram.error import TelegramError, BadRequest, NetworkError
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
 
-from shopgun import Session
+from shopgun import Session, Offer
 from cart import Cart
+from imagecache import ImageCache
+from chatstore import ChatStore
+from profiling import PROFILER, section, carry
+from webhook import ChatWorkers, WebhookServer
+import config
 from config import TELEGRAM_TOKEN, DEFAULT_LOCATION, DEFAULT_RADIUS
 
-from datetime import timedelta
+from datetime import datetime, timedelta
+from time import sleep
+from urllib.parse import urlparse
+
+# optional configuration
+CHAT_MEMORY_BUDGET = getattr(config, 'CHAT_MEMORY_BUDGET', 1000)
+ADMINS = getattr(config, 'ADMINS', [])
+SLOW_CALL_THRESHOLD = getattr(config, 'SLOW_CALL_THRESHOLD', 2.0)
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8443)
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+WEBHOOK_WORKERS = getattr(config, 'WEBHOOK_WORKERS', 4)
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 LOGGER = logging.getLogger('gnier')
 
-CHATS = {}
-CONFIG = {'chats': {}}
+# Resident chats, least recently used first
+CHATS = OrderedDict()
+CHATS_LOCK = threading.RLock()
+# Evicted chats that are still referenced, e.g. by a running handler
+EVICTED = weakref.WeakValueDictionary()
+# Refresh jobs by chat id, kept apart from the chats so they can be evicted
+JOBS = {}
+# When the next refresh of each chat is due
+DUE = {}
+STORE = ChatStore('GnierDB.sqlite3')
+
+# Chats with a refresh due within this window are never evicted
+CHAT_PIN_WINDOW = timedelta(minutes=15)
+
+# Number of concurrent searches when importing subscriptions
+IMPORT_WORKERS = 8
+
+# Number of runs profiled, when profiling is turned on without a number
+PROFILE_RUNS = 10
+
+# Telegram allows between 2 and 10 photos in a media group
+MEDIA_GROUP_SIZE = 10
+# Telegram rejects messages longer than this, counted in UTF-16 code units
+MESSAGE_LIMIT = 4096
+# Number of attempts at sending a message, when Telegram times out or asks us
+# to slow down
+SEND_ATTEMPTS = 3
+IMAGES = ImageCache('GnierImages.json', max_size=5000)
+
+
+class TimedRequest(Request):
+    """Requests to the Telegram API, timed as a section of the profiler."""
+
+    def post(self, url, data, timeout=None):
+        with section('telegram'):
+            return super().post(url, data, timeout)
+
+    def retrieve(self, url, timeout=None):
+        with section('telegram'):
+            return super().retrieve(url, timeout)
 
 
 def offer_text(offer):
@@ -47,6 +110,120 @@ def offer_text_expiring(offer):
             f'{human_timedelta(offer.timeleft())}.')
 
 
+def text_length(text):
+    """Length of a text, as counted by Telegram."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def reply_lines(message, lines):
+    """Reply with lines of text, split over as many messages as needed to keep
+    each within the message limit of Telegram."""
+    chunk = []
+    length = 0
+    for line in lines:
+        line = line[:MESSAGE_LIMIT]
+        while text_length(line) > MESSAGE_LIMIT:
+            line = line[:-1]
+        if chunk and length + text_length(line) + 1 > MESSAGE_LIMIT:
+            message.reply_text('\n'.join(chunk))
+            chunk = []
+            length = 0
+        if not chunk and not line:
+            continue
+        chunk.append(line)
+        length += text_length(line) + 1
+    if chunk:
+        message.reply_text('\n'.join(chunk))
+
+
+def send_retrying(send):
+    """Call a function sending to Telegram, and retry it if Telegram times out
+    or asks us to slow down."""
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            return send()
+        except BadRequest:
+            raise
+        except (RetryAfter, NetworkError) as error:
+            if attempt == SEND_ATTEMPTS:
+                raise
+            sleep(getattr(error, 'retry_after', 1))
+
+
+def send_offers(bot, chat_id, offers):
+    """Send offers to a chat. Offers with an image are sent in batches as media
+    groups, with the offer text as caption, and the rest as plain messages.
+    Return the offers that could not be delivered."""
+    undelivered = []
+    with_image = []
+    for offer in offers:
+        if offer.image():
+            with_image.append(offer)
+        elif not send_offer_text(bot, chat_id, offer):
+            undelivered.append(offer)
+
+    for i in range(0, len(with_image), MEDIA_GROUP_SIZE):
+        batch = with_image[i:i + MEDIA_GROUP_SIZE]
+        undelivered.extend(send_offer_images(bot, chat_id, batch))
+
+    if with_image:
+        IMAGES.save()
+    return undelivered
+
+
+def send_offer_text(bot, chat_id, offer):
+    """Send an offer as a plain message. Return whether it was delivered."""
+    try:
+        text = offer_text(offer)
+        send_retrying(lambda: bot.send_message(chat_id, text=text))
+        return True
+    except TelegramError:
+        LOGGER.exception('Could not send offer %s.', offer.offer_id)
+        return False
+
+
+def send_offer_images(bot, chat_id, offers):
+    """Send a single media group of offer images. Images that have been sent
+    before are referenced by their Telegram file id instead of their URL.
+    Return the offers that could not be delivered."""
+    urls = [offer.image() for offer in offers]
+    captions = [offer_text(offer) for offer in offers]
+    file_ids = [IMAGES.get(url) for url in urls]
+
+    def send(images):
+        if len(images) == 1:
+            return [bot.send_photo(chat_id, images[0], caption=captions[0])]
+        media = [InputMediaPhoto(image, caption=caption)
+                 for image, caption in zip(images, captions)]
+        return bot.send_media_group(chat_id, media)
+
+    try:
+        messages = send_retrying(lambda: send(
+            [file_id or url for file_id, url in zip(file_ids, urls)]))
+    except TelegramError:
+        messages = None
+        if any(file_ids):
+            # a cached file id might be rejected, so fall back to the URLs
+            LOGGER.warning('Could not send cached images, sending from URLs.')
+            for url in urls:
+                IMAGES.forget(url)
+            try:
+                messages = send_retrying(lambda: send(urls))
+            except TelegramError:
+                pass
+
+    if messages is None:
+        # the images could not be sent, so send the offers without images
+        LOGGER.warning('Could not send images, sending offers without them.')
+        return [offer for offer in offers
+                if not send_offer_text(bot, chat_id, offer)]
+
+    for url, message in zip(urls, messages):
+        if message.photo:
+            IMAGES.put(url, message.photo[-1].file_id)
+    return []
+
+
 def human_timedelta(delta):
     """Return a string representing the time delta in a (danish) human readable
     format.
@@ -86,7 +263,8 @@ class Chat:
     """User data, subscription storage, and update scheduling."""
     def __init__(self, chat_id, on_config_updated=None):
         self.chat_id = chat_id
-        self.job = None
+        self.refresh = None
+        self.updating = False
         self.cart = Cart()
         self.radius = DEFAULT_RADIUS
         self.lat, self.lon = DEFAULT_LOCATION
@@ -94,27 +272,107 @@ class Chat:
 
     @staticmethod
     def get(chat_id):
-        """Get existing or created chat."""
-        if chat_id not in CHATS:
-            CHATS[chat_id] = Chat(chat_id, handle_chat_update)
-        return CHATS[chat_id]
+        """Get a resident chat, or load it from the database, or create it.
+        Loading a chat may evict the least recently used chats."""
+        with CHATS_LOCK:
+            if chat_id in CHATS:
+                CHATS.move_to_end(chat_id)
+                return CHATS[chat_id]
+
+            # an evicted chat that is still in use is made resident again,
+            # so that there is never more than one chat with the same id
+            chat = EVICTED.pop(chat_id, None)
+            if chat is None:
+                chat_db = STORE.get(chat_id)
+                if chat_db is None:
+                    chat = Chat(chat_id, handle_chat_update)
+                else:
+                    chat = Chat.from_config(chat_db, handle_chat_update)
+            CHATS[chat_id] = chat
+            evict_chats()
+            return chat
+
+    @staticmethod
+    def from_config(chat_db, on_config_updated=None):
+        """Create a chat from its JSON representation."""
+        chat = Chat(chat_db['chat_id'], on_config_updated)
+        chat.lat = chat_db['lat']
+        chat.lon = chat_db['lon']
+        chat.radius = chat_db['radius']
+        if chat_db.get('refresh'):
+            chat.refresh = timedelta(seconds=chat_db['refresh'])
+        for sub_db in chat_db['subscriptions']:
+            sub = chat.cart.add_subscription(sub_db['query'], sub_db['price'])
+            sub.offers = [Offer(item) for item in sub_db.get('offers', [])]
+            warned = set(sub_db.get('warned', []))
+            sub.warned = {
+                offer for offer in sub.offers if offer.offer_id in warned
+            }
+        return chat
 
     def schedule(self, context, interval, first=None):
         """Schedule a chat to update at a given interval."""
-        if self.job is not None:
-            self.job.schedule_removal()
-        self.job = context.job_queue.run_repeating(
-            self.update, interval, interval if first is None else first)
+        schedule_chat(context.job_queue, self.chat_id, interval, first)
+        self.refresh = interval
+        self.config_updated()
+
+    def pinned(self):
+        """Is the chat being updated, or is an update due soon?"""
+        if self.updating:
+            return True
+        due = DUE.get(self.chat_id)
+        if due is None:
+            return False
+        return due - datetime.now() < CHAT_PIN_WINDOW
 
     def add_subscription(self, query, price):
         """Add a new subscription."""
         session = Session()
         sub = self.cart.add_subscription(query, price)
         offers = session.search(query, self.lat, self.lon, self.radius)
-        list(sub.handle_offers(offers))
+        with section('handle offers'):
+            list(sub.handle_offers(offers))
         sub.check_offers()
         self.config_updated()
 
+    def add_subscriptions(self, items):
+        """Search for each query and price pair concurrently, and add a
+        subscription for each search that succeeded. Return the added
+        subscriptions, and the queries whose search failed."""
+        try:
+            session = Session()
+        except Exception:
+            LOGGER.exception('Could not start a ShopGun session.')
+            return [], [query for query, _ in items]
+
+        def search(item):
+            query, _ = item
+            try:
+                return list(
+                    session.search(query, self.lat, self.lon, self.radius))
+            except Exception:
+                LOGGER.exception('Search for "%s" failed.', query)
+                return None
+
+        # the sections of the searches count towards this thread's timing
+        with section('concurrent searches'), \
+                ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+            results = list(executor.map(carry(search), items))
+
+        found = [(item, offers) for item, offers in zip(items, results)
+                 if offers is not None]
+        failed = [query for (query, _), offers in zip(items, results)
+                  if offers is None]
+
+        subs = self.cart.add_subscriptions([item for item, _ in found])
+        for sub, (_, offers) in zip(subs, found):
+            with section('handle offers'):
+                list(sub.handle_offers(offers))
+            sub.check_offers()
+        if subs:
+            self.config_updated()
+        return subs, failed
+
     def remove_subscription(self, idx):
         """Remove a subscription"""
         if self.cart.subscriptions and 0 < idx < len(self.cart.subscriptions):
@@ -123,21 +381,47 @@ class Chat:
 
     def update(self, context):
         """Check each subscription for updates."""
+        self.updating = True
+        try:
+            self._update(context)
+        finally:
+            self.updating = False
+
+    def _update(self, context):
+        """Search each subscription, and notify about new, expired and
+        expiring offers."""
         session = Session()
+        new_offers = []
 
-        for sub in self.cart:
-            offers = session.search(sub.query, self.lat, self.lon, self.radius)
-            for offer in sub.handle_offers(offers):
-                context.bot.send_message(self.chat_id, text=offer_text(offer))
-
-            updates = sub.check_offers()
-            for offer in updates['expired']:
-                context.bot.send_message(self.chat_id,
-                                         text=offer_text_expired(offer))
-            for offer in updates['expiring']:
-                context.bot_send_message(self.chat_id,
-                                         text=offer_text_expiring(offer))
-        self.config_updated()
+        # offers are recorded as they are found, so the ones found before an
+        # error must still be sent
+        try:
+            for sub in self.cart:
+                offers = session.search(sub.query, self.lat, self.lon,
+                                        self.radius)
+                with section('handle offers'):
+                    for offer in sub.handle_offers(offers):
+                        new_offers.append((sub, offer))
+
+                updates = sub.check_offers()
+                for offer in updates['expired']:
+                    context.bot.send_message(self.chat_id,
+                                             text=offer_text_expired(offer))
+                for offer in updates['expiring']:
+                    context.bot.send_message(self.chat_id,
+                                             text=offer_text_expiring(offer))
+        finally:
+            try:
+                undelivered = send_offers(
+                    context.bot, self.chat_id,
+                    [offer for _, offer in new_offers])
+                # forget undelivered offers, so the next update finds them
+                for sub, offer in new_offers:
+                    if offer in undelivered:
+                        sub.offers.remove(offer)
+                        sub.warned.discard(offer)
+            finally:
+                self.config_updated()
 
     def config_updated(self):
         """Called when a part of the configuration might be changed."""
@@ -155,15 +439,63 @@ class Chat:
             self.lon,
             'radius':
             self.radius,
+            'refresh':
+            self.refresh.total_seconds() if self.refresh else None,
             'subscriptions':
             list(
-                map(lambda sub: {
-                    'query': sub.query,
-                    'price': sub.price
-                }, self.cart))
+                map(
+                    lambda sub: {
+                        'query': sub.query,
+                        'price': sub.price,
+                        'offers': [offer.config() for offer in sub.offers],
+                        'warned': [offer.offer_id for offer in sub.warned]
+                    }, self.cart))
         }
 
 
+def schedule_chat(job_queue, chat_id, interval, first=None):
+    """Schedule a chat to update at a given interval. The job only refers to
+    the chat by id, so that the chat can be evicted in between updates."""
+    if first is None:
+        first = interval
+    if chat_id in JOBS:
+        JOBS[chat_id].schedule_removal()
+    JOBS[chat_id] = job_queue.run_repeating(update_chat,
+                                            interval,
+                                            first,
+                                            context=(chat_id, interval))
+    DUE[chat_id] = datetime.now() + first
+
+
+@PROFILER.timed
+def update_chat(context):
+    """Update a scheduled chat, loading it if it has been evicted."""
+    chat_id, interval = context.job.context
+    DUE[chat_id] = datetime.now() + interval
+    Chat.get(chat_id).update(context)
+
+
+def evict_chats():
+    """Evict the least recently used chats, until the resident chats fit in
+    the memory budget. Chats that are pinned are kept, and so is the most
+    recently used chat. An evicted chat is saved, and leaves memory once it is
+    no longer used."""
+    with CHATS_LOCK:
+        evicted = False
+        for chat in list(CHATS.values())[:-1]:
+            if len(CHATS) <= CHAT_MEMORY_BUDGET:
+                break
+            if chat.pinned():
+                continue
+            del CHATS[chat.chat_id]
+            STORE.put(chat.config())
+            EVICTED[chat.chat_id] = chat
+            evicted = True
+
+        if evicted:
+            LOGGER.debug('Evicted chats, %d chats resident.', len(CHATS))
+
+
 # Conversation state identifies for search conversation
 SEARCH_ASK_QUERY, SEARCH_ASK_PRICE, SEARCH_SHOW_RESULT = range(3)
 SEARCH_DONE, SEARCH_COMMAND, SEARCH_REMOVE = range(3, 6)
@@ -171,7 +503,11 @@ SEARCH_DONE, SEARCH_COMMAND, SEARCH_REMOVE = range(3, 6)
 # Conversation state identifiers for settings conversation
 SETTINGS_VIEW_SAVE, SETTINGS_ASK, SETTINGS_DONE = range(3)
 
+# Conversation state identifiers for import conversation
+IMPORT_ASK_LIST = 0
 
+
+@PROFILER.timed
 def start(update, context):
     """Start command."""
     lines = ('Vær hilset!',
@@ -182,6 +518,8 @@ def start(update, context):
              ' 🗑 /slet - slet en af dine søgninger',
              ' 📃 /liste - få en liste over dine søgninger',
              ' 💰 /tilbud - få en liste over dine tilbud',
+             ' 📥 /importer - tilføj en liste af søgninger på én gang',
+             ' 📤 /eksporter - få dine søgninger som en liste',
              ' ✍️ /indstil- for at ændre placering eller radius på søgninger')
     update.message.reply_text('\n'.join(lines))
 
@@ -190,6 +528,7 @@ def start(update, context):
     chat.schedule(context, timedelta(hours=6))
 
 
+@PROFILER.timed
 def search_convo_entry(update, context):
     """Entry into the search conversation."""
     keyboard = [[
@@ -202,6 +541,7 @@ def search_convo_entry(update, context):
     return SEARCH_COMMAND
 
 
+@PROFILER.timed
 def search_convo_ask_query(update, context):
     """Ask for a search query."""
     if update.callback_query:
@@ -215,6 +555,7 @@ def search_convo_ask_query(update, context):
     return SEARCH_ASK_PRICE
 
 
+@PROFILER.timed
 def search_convo_ask_price(update, context):
     """Handle search query, and ask for price."""
     user_data = context.user_data
@@ -225,6 +566,7 @@ def search_convo_ask_price(update, context):
     return SEARCH_SHOW_RESULT
 
 
+@PROFILER.timed
 def search_convo_show_result(update, context):
     """Handle price, perform query, and show result,
     and ask if the user wants to save it."""
@@ -238,13 +580,16 @@ def search_convo_show_result(update, context):
     offers = ses.search_all(query, chat.lat, chat.lon, chat.radius)
     too_expensive = 0
     total_offers = 0
+    cheap_offers = []
     for offer in offers:
         total_offers += 1
         if offer.price > price:
             too_expensive += 1
             continue
 
-        update.message.reply_text(offer_text(offer))
+        cheap_offers.append(offer)
+
+    send_offers(context.bot, chat.chat_id, cheap_offers)
 
     if total_offers == 0:
         update.message.reply_text(
@@ -265,6 +610,7 @@ def search_convo_show_result(update, context):
     return SEARCH_DONE
 
 
+@PROFILER.timed
 def search_convo_save(update, context):
     """Save the created search."""
     query = update.callback_query
@@ -281,6 +627,7 @@ def search_convo_save(update, context):
     return ConversationHandler.END
 
 
+@PROFILER.timed
 def search_convo_done(update, context):
     """End search conversation."""
     query = update.callback_query
@@ -291,6 +638,7 @@ def search_convo_done(update, context):
     return ConversationHandler.END
 
 
+@PROFILER.timed
 def search_convo_list(update, context):
     """List all saved searches."""
     if update.callback_query:
@@ -319,6 +667,7 @@ def search_convo_list(update, context):
     return ConversationHandler.END
 
 
+@PROFILER.timed
 def search_convo_ask_remove(update, context):
     """Ask which search to remove."""
     if update.callback_query:
@@ -359,6 +708,7 @@ def search_convo_ask_remove(update, context):
     return SEARCH_REMOVE
 
 
+@PROFILER.timed
 def search_convo_remove(update, context):
     """Remove the selected"""
     query = update.callback_query
@@ -376,6 +726,7 @@ def search_convo_remove(update, context):
     return ConversationHandler.END
 
 
+@PROFILER.timed
 def offers_list(update, context):
     """Show the currently found offers."""
     chat = Chat.get(update.message.chat_id)
@@ -401,6 +752,119 @@ def offers_list(update, context):
         update.message.reply_text('\n'.join(lines))
 
 
+def parse_subscriptions(text):
+    """Parse lines of the form "query;price". Return a list of query and price
+    pairs, and a list of the lines that could not be parsed."""
+    items = []
+    invalid = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            query, price = line.rsplit(';', 1)
+            query = query.strip()
+            price = float(price.strip().replace(',', '.'))
+        except ValueError:
+            invalid.append(line)
+            continue
+        if not query:
+            invalid.append(line)
+            continue
+        items.append((query, price))
+    return items, invalid
+
+
+def price_text(price):
+    """Text for a price, without losing any digits, but without a trailing
+    ".0" for whole prices."""
+    text = str(price)
+    if text.endswith('.0'):
+        return text[:-2]
+    return text
+
+
+@PROFILER.timed
+def import_convo_entry(update, context):
+    """Import the list following the command, or ask for a list."""
+    # the list may be pasted on the lines after the command itself
+    parts = update.message.text.split('\n', 1)
+    if len(parts) == 2 and parts[1].strip():
+        return import_convo_import(update, context, parts[1])
+
+    update.message.reply_text(
+        '❓ Send mig dine søgninger, én per linje, på formen "søgning;pris", '
+        'f.eks.:\n\nkaffe;30\nmælk;7,50\n\nSend /annuller for at stoppe.')
+    return IMPORT_ASK_LIST
+
+
+@PROFILER.timed
+def import_convo_cancel(update, context):
+    """End the import conversation when another command is sent."""
+    update.message.reply_text('📥 Importen er annulleret.')
+    return ConversationHandler.END
+
+
+@PROFILER.timed
+def import_convo_import(update, context, text=None):
+    """Add all subscriptions in a list, and reply with a summary."""
+    chat = Chat.get(update.message.chat_id)
+    items, invalid = parse_subscriptions(
+        update.message.text if text is None else text)
+
+    # skip queries that are already subscribed
+    known = {sub.query for sub in chat.cart}
+    duplicates = []
+    new_items = []
+    for query, price in items:
+        if query in known:
+            duplicates.append(query)
+            continue
+        known.add(query)
+        new_items.append((query, price))
+
+    subs, failed = [], []
+    if new_items:
+        subs, failed = chat.add_subscriptions(new_items)
+
+    lines = []
+    if subs:
+        lines.append(f'📥 {len(subs)} søgninger blev tilføjet:')
+        lines.extend(f'🔎 {sub.query} ({sub.price} kr.) - '
+                     f'{len(sub.offers)} tilbud' for sub in subs)
+    else:
+        lines.append('⁉️ Der blev ikke tilføjet nogen søgninger.')
+    if failed:
+        lines.append('')
+        lines.append('Disse søgninger fejlede, så prøv dem igen senere:')
+        lines.extend(f'⚠️ {query}' for query in failed)
+    if duplicates:
+        lines.append('')
+        lines.append('Disse søgninger havde du allerede:')
+        lines.extend(f'♻️ {query}' for query in duplicates)
+    if invalid:
+        lines.append('')
+        lines.append('Disse linjer forstod jeg ikke:')
+        lines.extend(f'❌ {line}' for line in invalid)
+
+    reply_lines(update.message, lines)
+    return ConversationHandler.END
+
+
+@PROFILER.timed
+def export_subscriptions(update, context):
+    """Reply with all subscriptions, in the format used for importing."""
+    chat = Chat.get(update.message.chat_id)
+
+    if not chat.cart.subscriptions:
+        update.message.reply_text('⁉️ Du har ingen søgninger at eksportere.')
+        return
+
+    reply_lines(update.message,
+                [f'{sub.query};{price_text(sub.price)}' for sub in chat.cart])
+
+
+@PROFILER.timed
 def settings_convo_view_save(update, context):
     """Save location setting."""
     chat = Chat.get(update.message.chat_id)
@@ -422,6 +886,8 @@ def settings_convo_view_save(update, context):
         except ValueError:
             pass
 
+    chat.config_updated()
+
     keyboard = [[
         InlineKeyboardButton('Opdater radius', callback_data='radius'),
         InlineKeyboardButton('Opdater lokation', callback_data='location'),
@@ -438,6 +904,7 @@ def settings_convo_view_save(update, context):
     return SETTINGS_ASK
 
 
+@PROFILER.timed
 def settings_convo_ask_location(update, context):
     """Ask user for location."""
     query = update.callback_query
@@ -450,6 +917,7 @@ def settings_convo_ask_location(update, context):
     return SETTINGS_VIEW_SAVE
 
 
+@PROFILER.timed
 def settings_convo_ask_radius(update, context):
     """Ask user for radius"""
     query = update.callback_query
@@ -463,6 +931,7 @@ def settings_convo_ask_radius(update, context):
     return SETTINGS_VIEW_SAVE
 
 
+@PROFILER.timed
 def settings_convo_done(update, context):
     """End settings conversation."""
     query = update.callback_query
@@ -475,31 +944,86 @@ def settings_convo_done(update, context):
     return ConversationHandler.END
 
 
+def profile_command(update, context):
+    """Profile the next runs of handlers and updates. Only for admins."""
+    if update.effective_user.id not in ADMINS:
+        return
+
+    runs = PROFILE_RUNS
+    if context.args and context.args[0].isdigit():
+        runs = int(context.args[0])
+    PROFILER.arm(runs)
+    update.message.reply_text(f'⏱️ De næste {runs} kørsler bliver profileret.')
+
+
 def handle_chat_update(chat_db):
     """Save configuration."""
-    CONFIG['chats'][str(chat_db['chat_id'])] = chat_db
-    with open('GnierDB.json', 'w') as db_file:
-        json.dump(CONFIG, db_file)
+    STORE.put(chat_db)
+
+
+def run_webhook(updater):
+    """Receive updates through a webhook, and process them with a pool of
+    workers, until interrupted."""
+    # without a configured secret, a new one is registered on every start
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    url_path = urlparse(WEBHOOK_URL).path or '/'
+
+    workers = ChatWorkers(updater.dispatcher, WEBHOOK_WORKERS)
+    server = WebhookServer((WEBHOOK_LISTEN, WEBHOOK_PORT), url_path, secret,
+                           updater.bot, workers)
+
+    updater.bot.set_webhook(WEBHOOK_URL, secret_token=secret)
+    updater.job_queue.start()
+    workers.start()
+    LOGGER.info('Receiving updates on %s:%d%s.', WEBHOOK_LISTEN, WEBHOOK_PORT,
+                url_path)
+
+    # stop gracefully on the same signals as updater.idle(). The server is
+    # shut down from another thread, as shutdown() waits for serve_forever()
+    # which runs in this thread.
+    def stop(signum, frame):
+        LOGGER.info('Received signal %d, stopping webhook.', signum)
+        threading.Thread(target=server.shutdown).start()
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, stop)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        workers.stop()
+        # the dispatcher has run_async threads, which keep the process alive
+        updater.dispatcher.stop()
+        updater.job_queue.stop()
 
 
 def main():
     """Run bot."""
-    if os.path.isfile('GnierDB.json'):
-        with open('GnierDB.json', 'r') as db_file:
-            database = json.load(db_file)
-            for chat_id in database['chats']:
-                chat_data = database['chats'][chat_id]
-                chat = Chat.get(chat_data['chat_id'])
-                chat.lat = chat_data['lat']
-                chat.on = chat_data['lon']
-                chat.radius = chat_data['radius']
-                for sub in chat_data['subscriptions']:
-                    chat.add_subscription(sub['query'], sub['price'])
-
-    updater = Updater(TELEGRAM_TOKEN, use_context=True)
+    IMAGES.load()
+    STORE.open()
+    STORE.migrate('GnierDB.json')
+
+    PROFILER.threshold = SLOW_CALL_THRESHOLD
+    # SIGUSR1 turns on profiling, like the /profil command
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: PROFILER.arm(PROFILE_RUNS))
+
+    # the connection pool must fit the workers of the dispatcher, 4 by
+    # default, and the workers of the webhook
+    con_pool_size = max(4, WEBHOOK_WORKERS) + 4
+    bot = Bot(TELEGRAM_TOKEN,
+              request=TimedRequest(con_pool_size=con_pool_size))
+    updater = Updater(bot=bot, use_context=True)
+
+    # chats are loaded when they are used, only their refreshes are scheduled
+    for chat_id, refresh in STORE.refreshes():
+        schedule_chat(updater.job_queue, chat_id, timedelta(seconds=refresh))
+
     disp = updater.dispatcher
     disp.add_handler(CommandHandler("start", start))
     disp.add_handler(CommandHandler("help", start))
+    disp.add_handler(CommandHandler('profil', profile_command))
 
     # conversation for changing user settings
     settings_convo = ConversationHandler(
@@ -524,6 +1048,21 @@ def main():
 
     disp.add_handler(CommandHandler('tilbud', offers_list))
 
+    # conversation for importing and exporting subscriptions in bulk
+    import_convo = ConversationHandler(
+        entry_points=[CommandHandler('importer', import_convo_entry)],
+        states={
+            IMPORT_ASK_LIST: [
+                MessageHandler(Filters.text & ~Filters.command,
+                               import_convo_import)
+            ]
+        },
+        fallbacks=[MessageHandler(Filters.command, import_convo_cancel)])
+    # in its own group, so that a command cancelling the import is also
+    # handled by its own handler
+    disp.add_handler(import_convo, group=1)
+    disp.add_handler(CommandHandler('eksporter', export_subscriptions))
+
     # conversation for searching and adding subscriptions
     search_convo = ConversationHandler(
         entry_points=[
@@ -560,6 +1099,10 @@ def main():
         fallbacks=[])
     disp.add_handler(search_convo)
 
+    if WEBHOOK_URL:
+        run_webhook(updater)
+        return
+
     # Start the Bot
     updater.start_polling()
 
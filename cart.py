@@ -14,6 +14,12 @@ class Cart:
         self.subscriptions.append(sub)
         return sub
 
+    def add_subscriptions(self, items):
+        """Add a subscription to the cart for each query and price pair."""
+        subs = [Subscription(query, price) for query, price in items]
+        self.subscriptions.extend(subs)
+        return subs
+
     def remove_subscription(self, subscription):
         """Remove a subscription from the cart."""
         self.subscriptions.remove(subscription)
@@ -34,7 +40,7 @@ class Subscription:
 
     def handle_offers(self, offers):
         """Perform an update."""
-        found = {offer.ident: False for offer in self.offers}
+        found = {offer.offer_id: False for offer in self.offers}
 
         # get new offers
         for offer in offers:
@@ -55,8 +61,7 @@ class Subscription:
 
         for offer in self.offers:
             if offer.expired():
-                self.offers.remove(offer)
-                self.warned.remove(offer)
+                self.warned.discard(offer)
                 updates['expired'].append(offer)
             elif offer.expiring() and offer not in self.warned:
                 self.warned.add(offer)
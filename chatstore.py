@@ -0,0 +1,61 @@
+"""Storage of chats in an SQLite database, with a row per chat, so that chats
+can be loaded and saved one at a time."""
+
+import os
+import json
+import sqlite3
+import threading
+
+
+class ChatStore:
+    """A database of the JSON representations of chats, keyed by chat id."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Open the database, creating it if it does not exist."""
+        # the connection is shared by the threads, guarded by the lock
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS chats ('
+                'chat_id INTEGER PRIMARY KEY, refresh REAL, data TEXT)')
+
+    def migrate(self, json_path):
+        """Move the chats of an old JSON database into the store. The old
+        database is renamed, so that it is only migrated once."""
+        if not os.path.isfile(json_path):
+            return
+        with open(json_path, 'r') as db_file:
+            database = json.load(db_file)
+        for chat_db in database['chats'].values():
+            self.put(chat_db)
+        os.replace(json_path, f'{json_path}.migrated')
+
+    def get(self, chat_id):
+        """Get the representation of a chat, or None if it is not stored."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM chats WHERE chat_id = ?',
+                (chat_id, )).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, chat_db):
+        """Store the representation of a chat."""
+        data = json.dumps(chat_db)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO chats (chat_id, refresh, data) '
+                'VALUES (?, ?, ?)',
+                (chat_db['chat_id'], chat_db.get('refresh'), data))
+
+    def refreshes(self):
+        """Get the chat id and refresh interval in seconds of every chat that
+        is refreshed, without loading the chats."""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT chat_id, refresh FROM chats '
+                'WHERE refresh IS NOT NULL').fetchall()
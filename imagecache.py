@@ -0,0 +1,88 @@
+"""A persisted cache mapping image URLs to Telegram file ids, so that each
+offer image only has to be uploaded to Telegram once."""
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+LOGGER = logging.getLogger('gnier.imagecache')
+
+
+class ImageCache:
+    """A bounded mapping from image URLs to Telegram file ids. When the cache
+    grows beyond its size, the least recently used images are evicted."""
+
+    def __init__(self, path, max_size=1000):
+        self.path = path
+        self.max_size = max_size
+        self.file_ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # whether images were added or forgotten since the last save
+        self.changed = False
+
+    def load(self):
+        """Load the cache from disk, if it has been saved before. An
+        unreadable cache is ignored, as the images can just be uploaded
+        again."""
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as cache_file:
+                items = json.load(cache_file)
+            for url, file_id in items:
+                self.put(url, file_id)
+            self.changed = False
+        except (OSError, ValueError, TypeError):
+            LOGGER.warning('Ignoring unreadable image cache %s.', self.path)
+
+    def save(self):
+        """Save the cache to disk, least recently used first, if images were
+        added or forgotten since it was last saved. The cache is written to a
+        temporary file first, which then replaces the old file, so that the
+        file is never partially written."""
+        with self.save_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                self.changed = False
+                items = list(self.file_ids.items())
+            tmp_path = f'{self.path}.tmp'
+            try:
+                with open(tmp_path, 'w') as cache_file:
+                    json.dump(items, cache_file)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                # save again next time
+                with self.lock:
+                    self.changed = True
+                raise
+
+    def get(self, url):
+        """Get the file id of an image, or None if it is not cached."""
+        with self.lock:
+            if url not in self.file_ids:
+                return None
+            self.file_ids.move_to_end(url)
+            return self.file_ids[url]
+
+    def put(self, url, file_id):
+        """Remember the file id of an uploaded image."""
+        with self.lock:
+            if self.file_ids.get(url) != file_id:
+                self.changed = True
+            self.file_ids[url] = file_id
+            self.file_ids.move_to_end(url)
+            while len(self.file_ids) > self.max_size:
+                self.file_ids.popitem(last=False)
+
+    def forget(self, url):
+        """Forget the file id of an image, e.g. if Telegram rejected it."""
+        with self.lock:
+            if self.file_ids.pop(url, None) is not None:
+                self.changed = True
+
+    def __len__(self):
+        return len(self.file_ids)
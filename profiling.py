@@ -0,0 +1,201 @@
+"""On-demand profiling of handlers and updates, and logging of slow calls with
+a breakdown of where their time went."""
+
+import os
+import logging
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from datetime import datetime
+from time import perf_counter
+
+LOGGER = logging.getLogger('gnier.profiling')
+
+# The breakdowns of the calls being timed in the current thread
+_LOCAL = threading.local()
+
+
+def _breakdowns():
+    if not hasattr(_LOCAL, 'breakdowns'):
+        _LOCAL.breakdowns = []
+    return _LOCAL.breakdowns
+
+
+class Breakdown:
+    """Time spent in named sections of a call. Time spent in a nested section
+    only counts towards the innermost section. Time spent in other threads on
+    behalf of the call can be merged in, so the sections can add up to more
+    than the duration of the call."""
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.stack = []
+        self.mark = perf_counter()
+        self.lock = threading.Lock()
+
+    def _charge(self):
+        now = perf_counter()
+        name = self.stack[-1] if self.stack else 'other'
+        with self.lock:
+            self.times[name] += now - self.mark
+        self.mark = now
+
+    def enter(self, name):
+        """Start counting time towards a section."""
+        self._charge()
+        self.stack.append(name)
+
+    def exit(self):
+        """Stop counting time towards the innermost section."""
+        self._charge()
+        self.stack.pop()
+
+    def finish(self):
+        """Count the remaining time towards the current section."""
+        self._charge()
+
+    def merge(self, other):
+        """Add the section times of another breakdown."""
+        with self.lock:
+            for name, time in other.times.items():
+                self.times[name] += time
+
+    def __str__(self):
+        with self.lock:
+            times = sorted(self.times.items(), key=lambda item: -item[1])
+        return ', '.join(f'{name} {time:.3f}s' for name, time in times)
+
+
+@contextmanager
+def section(name):
+    """Count the time spent in the block towards a section of the calls being
+    timed in the current thread."""
+    breakdowns = list(_breakdowns())
+    for breakdown in breakdowns:
+        breakdown.enter(name)
+    try:
+        yield
+    finally:
+        for breakdown in breakdowns:
+            breakdown.exit()
+
+
+@contextmanager
+def _timing():
+    breakdown = Breakdown()
+    _breakdowns().append(breakdown)
+    try:
+        yield breakdown
+    finally:
+        breakdown.finish()
+        _breakdowns().remove(breakdown)
+
+
+def carry(func):
+    """Wrap a function that runs in another thread, e.g. in an executor, so
+    that its sections count towards the calls being timed in the current
+    thread."""
+    parents = list(_breakdowns())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with _timing() as breakdown:
+                return func(*args, **kwargs)
+        finally:
+            for parent in parents:
+                parent.merge(breakdown)
+    return wrapper
+
+
+class Profiler:
+    """Times handlers and updates, logging those slower than the threshold.
+    When armed, the next runs are profiled with cProfile, and the profiles are
+    written to the directory."""
+
+    def __init__(self, directory='profiles', threshold=2.0):
+        self.directory = directory
+        self.threshold = threshold
+        self.remaining = 0
+        self.active = False
+        self.lock = threading.Lock()
+
+    def arm(self, runs):
+        """Profile the next number of runs."""
+        with self.lock:
+            self.remaining = runs
+        LOGGER.info('Profiling the next %d runs.', runs)
+
+    def _claim(self):
+        # only one profiler can be enabled at a time
+        with self.lock:
+            if self.remaining <= 0 or self.active:
+                return False
+            self.remaining -= 1
+            self.active = True
+            return True
+
+    def _dump(self, profile, name):
+        # a profile that cannot be written must not fail the profiled call,
+        # nor stop later runs from being profiled
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f'{datetime.now():%Y%m%d-%H%M%S-%f}-{name}.prof')
+            profile.dump_stats(path)
+            LOGGER.info('Wrote profile of %s to %s.', name, path)
+        except OSError:
+            LOGGER.exception('Could not write profile of %s.', name)
+        finally:
+            with self.lock:
+                self.active = False
+
+    def timed(self, func):
+        """Decorate a handler or job, to time it, and profile it when armed.
+        Calls nested in another timed call are counted towards that."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_LOCAL, 'timed', False):
+                return func(*args, **kwargs)
+
+            _LOCAL.timed = True
+            profile = cProfile.Profile() if self._claim() else None
+            start = perf_counter()
+            try:
+                with _timing() as breakdown:
+                    if profile is not None:
+                        profile.enable()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        if profile is not None:
+                            profile.disable()
+            finally:
+                _LOCAL.timed = False
+                if profile is not None:
+                    self._dump(profile, func.__name__)
+                total = perf_counter() - start
+                if total >= self.threshold:
+                    LOGGER.warning('Slow call to %s took %.3fs: %s',
+                                   func.__name__, total, breakdown)
+        return wrapper
+
+    @contextmanager
+    def slow_call(self, name):
+        """Log the block, with a breakdown of its sections, if it is slower
+        than the threshold."""
+        start = perf_counter()
+        try:
+            with _timing() as breakdown:
+                yield
+        finally:
+            total = perf_counter() - start
+            if total >= self.threshold:
+                LOGGER.warning('Slow %s took %.3fs: %s', name, total,
+                               breakdown)
+
+
+PROFILER = Profiler()
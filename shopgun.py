@@ -8,6 +8,7 @@ import requests
 from dateutil.parser import isoparse
 
 from config import SHOPGUN_API_KEY as api_key, SHOPGUN_API_SECRET as api_secret
+from profiling import PROFILER, section
 
 
 class Session:
@@ -17,10 +18,11 @@ class Session:
         self.api_url = "https://api.etilbudsavis.dk/v2"
         body = {}
         body['api_key'] = api_key
-        response = requests.post(
-            f"{self.api_url}/sessions",
-            data=json.dumps(body),
-            headers={'Content-Type': 'application/json'})
+        with section('shopgun handshake'):
+            response = requests.post(
+                f"{self.api_url}/sessions",
+                data=json.dumps(body),
+                headers={'Content-Type': 'application/json'})
         if response.status_code == 201:
             data = response.json()
             self.token = data['token']
@@ -55,11 +57,16 @@ class Session:
         queryparts = map(lambda param: '='.join(map(str, param)),
                          params.items())
 
-        response = requests.get(
-            f"{self.api_url}/offers/search?{'&'.join(queryparts)}")
+        with PROFILER.slow_call(f'search for "{query}"'):
+            with section('shopgun search'):
+                response = requests.get(
+                    f"{self.api_url}/offers/search?{'&'.join(queryparts)}")
+            with section('json parsing'):
+                items = response.json()
+            with section('offer parsing'):
+                offers = [Offer(item) for item in items]
 
-        for item in response.json():
-            yield Offer(item)
+        yield from offers
 
     def search_all(self, query, lat=None, lon=None, radius=None):
         """Search that paginates to retrieve all Offers."""
@@ -89,6 +96,29 @@ class Offer:
         self.store = item['branding']['name']
         self.images = item.get('images')
 
+    def config(self):
+        """Dump a representation of the Offer to JSON, from which it can be
+        recreated."""
+        item = {
+            'id': self.offer_id,
+            'heading': self.heading,
+            'pricing': {'price': self.price},
+            'quantity': self.quantity,
+            'branding': {'name': self.store},
+            'images': self.images
+        }
+        if self.run_till:
+            item['run_till'] = self.run_till.isoformat()
+        if self.run_from:
+            item['run_from'] = self.run_from.isoformat()
+        return item
+
+    def image(self):
+        """Get the URL of the offer thumbnail, or None if it has no images."""
+        if not self.images:
+            return None
+        return self.images.get('thumb') or self.images.get('view')
+
     def timeleft(self):
         """Get the time left on the offer."""
         if not self.run_till:
@@ -0,0 +1,201 @@
+"""A webhook receiver for Telegram updates, dispatching the updates to a pool
+of workers while keeping the updates of each chat in order. Run as a script,
+it is a test client that posts synthetic updates to a receiver."""
+
+import json
+import hmac
+import queue
+import logging
+import argparse
+import threading
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from telegram import Update
+
+LOGGER = logging.getLogger('gnier.webhook')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ChatWorkers:
+    """A pool of threads processing updates with a dispatcher. Updates from
+    the same chat always go to the same thread, so that they are processed in
+    the order they were received, and conversation states stay consistent."""
+
+    def __init__(self, dispatcher, workers=4):
+        self.dispatcher = dispatcher
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self._work,
+                             args=(updates, ),
+                             name=f'webhook_worker_{i}',
+                             daemon=True)
+            for i, updates in enumerate(self.queues)
+        ]
+
+    def start(self):
+        """Start the worker threads."""
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the worker threads, after the queued updates are processed."""
+        for updates in self.queues:
+            updates.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def put(self, update):
+        """Queue an update for the worker of its chat."""
+        if update.effective_chat is not None:
+            key = update.effective_chat.id
+        elif update.effective_user is not None:
+            key = update.effective_user.id
+        else:
+            key = 0
+        self.queues[key % len(self.queues)].put(update)
+
+    def _work(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:
+                LOGGER.exception('Failed to process update %s.',
+                                 update.update_id)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receives the updates posted by Telegram."""
+
+    # keep connections alive between updates
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        """Verify the secret token, and queue the posted update."""
+        server = self.server
+        # the body is left unread on errors, so the connection is closed
+        if self.path != server.url_path:
+            self.close_connection = True
+            self.send_error(404)
+            return
+
+        token = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), server.secret.encode()):
+            LOGGER.warning('Rejected update with wrong secret token from %s.',
+                           self.client_address[0])
+            self.close_connection = True
+            self.send_error(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length))
+            if not isinstance(data, dict):
+                raise ValueError('The update is not an object.')
+            update = Update.de_json(data, server.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.close_connection = True
+            self.send_error(400)
+            return
+
+        if update is not None:
+            server.workers.put(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """An HTTP server receiving updates at a path, and passing them on to the
+    chat workers."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, url_path, secret, bot, workers):
+        super().__init__(address, WebhookHandler)
+        self.url_path = url_path
+        self.secret = secret
+        self.bot = bot
+        self.workers = workers
+
+
+def synthetic_update(update_id, chat_id, text):
+    """Create a synthetic update with a private message."""
+    update = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {
+                'id': chat_id,
+                'type': 'private'
+            },
+            'from': {
+                'id': chat_id,
+                'is_bot': False,
+                'first_name': 'Gnier'
+            },
+            'text': text
+        }
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        update['message']['entities'] = [{
+            'type': 'bot_command',
+            'offset': 0,
+            'length': len(command)
+        }]
+    return update
+
+
+def post_updates(url, secret, chats, messages, text):
+    """Post a number of messages from each of a number of chats to a webhook
+    receiver. The messages of each chat are posted in order, while the chats
+    are posted concurrently. Return the time it took in seconds."""
+    def post_chat(chat_id):
+        with requests.Session() as session:
+            session.headers[SECRET_HEADER] = secret
+            for i in range(messages):
+                update = synthetic_update(chat_id * messages + i, chat_id,
+                                          text)
+                response = session.post(url, json=update)
+                response.raise_for_status()
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=chats) as executor:
+        list(executor.map(post_chat, range(1, chats + 1)))
+    return perf_counter() - start
+
+
+def main():
+    """Post synthetic updates to a webhook receiver."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('url', help='url of the webhook receiver')
+    parser.add_argument('--secret', default='', help='secret token')
+    parser.add_argument('--chats', type=int, default=10,
+                        help='number of chats posting messages')
+    parser.add_argument('--messages', type=int, default=5,
+                        help='number of messages posted by each chat')
+    parser.add_argument('--text', default='/liste',
+                        help='text of the messages')
+    args = parser.parse_args()
+
+    elapsed = post_updates(args.url, args.secret, args.chats, args.messages,
+                           args.text)
+    total = args.chats * args.messages
+    print(f'Posted {total} updates in {elapsed:.2f}s '
+          f'({total / elapsed:.1f} updates/s).')
+
+
+if __name__ == '__main__':
+    main()